@@ -0,0 +1,40 @@
+import numpy as np
+from numba import prange
+
+
+# NOTE:
+# Plain python body of the extrusion kernel. It's compiled by numba in two
+# ways: jit in `extrude_pixels.py` (where prange spreads rows across
+# threads) and ahead-of-time in `_extrude_native.py` (where prange is
+# a plain range). Keep the single definition here, so the two don't drift
+def extrude(inp_pixels, out_pixels):
+    n_rows, n_cols = inp_pixels.shape[:2]
+    steps = np.array(((-1, 0), (0, -1), (1, 0), (0, 1)))
+    for i in prange(n_rows):
+        for j in range(n_cols):
+            if inp_pixels[i, j, 3] != 0:
+                continue
+
+            r = g = b = a = 0
+            n = 0
+            for k in range(len(steps)):
+                si = i + steps[k, 1]
+                sj = j + steps[k, 0]
+                if si < 0 or si >= n_rows:
+                    continue
+                if sj < 0 or sj >= n_cols:
+                    continue
+                if inp_pixels[si, sj, 3] > 0:
+                    r += int(inp_pixels[si, sj, 0])
+                    g += int(inp_pixels[si, sj, 1])
+                    b += int(inp_pixels[si, sj, 2])
+                    a += int(inp_pixels[si, sj, 3])
+                    n += 1
+
+            if n == 0:
+                continue
+
+            out_pixels[i, j, 0] = r // n
+            out_pixels[i, j, 1] = g // n
+            out_pixels[i, j, 2] = b // n
+            out_pixels[i, j, 3] = a // n
@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from numba.pycc import CC
+
+from _extrude_kernel import extrude
+
+_THIS_DIR = Path(__file__).parent
+
+# NOTE:
+# Ahead-of-time build of the extrusion kernel, so the `extrude_pixels`
+# doesn't pay the numba jit compilation on each run.
+# Build it once with: python tools/_extrude_native.py
+# (needs numba from tools/requirements.txt)
+# The kernel is exported for 8-bit pixels only, `extrude_pixels` must not
+# call it with other dtypes.
+# numba.pycc is pending deprecation (numba 0.68 raises
+# NumbaPendingDeprecationWarning on import), so this build may need to
+# move to another AOT mechanism once pycc is removed.
+cc = CC("extrude_native")
+cc.output_dir = str(_THIS_DIR)
+cc.export("extrude", "void(u1[:,:,:], u1[:,:,:])")(extrude)
+
+
+if __name__ == "__main__":
+    cc.compile()
@@ -1,10 +1,11 @@
 import json
-import re
+import math
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from itertools import chain
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 
 import cv2
 import numpy as np
@@ -17,6 +18,8 @@ _ASSETS_DIR = _ROOT_DIR / "resources/sprite_sheets"
 _SPRITE_LAYER = "sprite"
 _MASK_LAYER_PREFIX = "mask_"
 
+_N_DECODE_WORKERS = 8
+
 
 @dataclass
 class Sprite:
@@ -33,19 +36,6 @@ class Sprite:
     def w(self):
         return self.image.shape[1]
 
-    @property
-    def tr(self):
-        return (self.tl[0] + self.w, self.tl[1])
-
-    @property
-    def bl(self):
-        return (self.tl[0], self.tl[1] + self.h)
-
-    def get_neighbor_tls(self):
-        bl = self.bl
-        tr = self.tr
-        return [(bl[0], bl[1] + 1), (tr[0] + 1, tr[1])]
-
     def to_meta(self):
         # NOTE:
         # When convertic sprite to the meta (coordinates on the sprite sheet)
@@ -91,6 +81,85 @@ class Mask:
         }
 
 
+def _read_image(file_path: Path) -> np.ndarray:
+    return cv2.imread(str(file_path), cv2.IMREAD_UNCHANGED)
+
+
+def _get_frames_grid(
+    xs: np.ndarray, ys: np.ndarray, w: int, h: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    rows = ys[:, None, None] + np.arange(h)[None, :, None]
+    cols = xs[:, None, None] + np.arange(w)[None, None, :]
+    return rows, cols
+
+
+def _crop_frames(
+    sheet: np.ndarray, xs: np.ndarray, ys: np.ndarray, w: int, h: int
+) -> np.ndarray:
+    rows, cols = _get_frames_grid(xs, ys, w, h)
+    return sheet[rows, cols]
+
+
+def _blit_frames(
+    sheet: np.ndarray, xs: np.ndarray, ys: np.ndarray, images: np.ndarray
+):
+    h, w = images.shape[1:3]
+    rows, cols = _get_frames_grid(xs, ys, w, h)
+    sheet[rows, cols] = images
+
+
+def _pack_skyline(
+    sizes: List[Tuple[int, int]], sheet_w: int
+) -> List[Tuple[int, int]]:
+    # NOTE:
+    # Bottom-left skyline packer. The skyline is a list of (x, y, w)
+    # segments which covers the whole sheet width, where y is the lowest
+    # free row above the segment. Each rectangle is placed at the position
+    # with the smallest y (and then x), after which the skyline is updated
+    skyline = [(0, 0, sheet_w)]
+    tls = []
+    for w, h in sizes:
+        best = None
+        for i, (x, _, _) in enumerate(skyline):
+            if x + w > sheet_w:
+                break
+
+            y = 0
+            j = i
+            while skyline[j][0] < x + w:
+                y = max(y, skyline[j][1])
+                j += 1
+                if j == len(skyline):
+                    break
+
+            if best is None or (y, x) < best[:2]:
+                best = (y, x, i)
+
+        if best is None:
+            raise ValueError(f"Rectangle {w}x{h} is wider than the sheet")
+
+        y, x, i = best
+        tls.append((x, y))
+
+        new_skyline = skyline[:i] + [(x, y + h, w)]
+        for sx, sy, sw in skyline[i:]:
+            if sx + sw <= x + w:
+                continue
+            elif sx < x + w:
+                new_skyline.append((x + w, sy, sx + sw - x - w))
+            else:
+                new_skyline.append((sx, sy, sw))
+
+        skyline = []
+        for segment in new_skyline:
+            if skyline and skyline[-1][1] == segment[1]:
+                sx, sy, sw = skyline.pop()
+                segment = (sx, sy, sw + segment[2])
+            skyline.append(segment)
+
+    return tls
+
+
 if __name__ == "__main__":
     out_dir = _ASSETS_DIR
     out_dir.mkdir(exist_ok=True, parents=True)
@@ -98,25 +167,31 @@ if __name__ == "__main__":
     # --------------------------------------------------------------------
     # Parse aseprite files and extract sprite images from png images
     sprites = defaultdict(list)
-    masks = defaultdict(lambda: defaultdict(defaultdict))
-    for file_path in _ASEPRITE_DIR.iterdir():
-        if not str(file_path).endswith(".json"):
-            continue
-
-        dir_ = file_path.parent
-        sprite_name = re.sub(r"\.json$", "", file_path.name)
-        meta_fp = dir_ / (sprite_name + ".json")
+    masks = {}
+    meta_fps = list(_ASEPRITE_DIR.glob("*.json"))
+    metas = {}
+    for meta_fp in meta_fps:
         with open(meta_fp) as f:
-            meta = json.load(f)
+            metas[meta_fp] = json.load(f)
+
+    # NOTE:
+    # Png decoding releases the GIL, so all sheets are decoded in
+    # parallel threads before the frames extraction
+    sheet_fps = [fp.parent / metas[fp]["meta"]["image"] for fp in meta_fps]
+    with ThreadPoolExecutor(max_workers=_N_DECODE_WORKERS) as executor:
+        sheets = dict(zip(meta_fps, executor.map(_read_image, sheet_fps)))
+
+    for meta_fp in meta_fps:
+        meta = metas[meta_fp]
         frames = meta["frames"]
         meta = meta["meta"]
 
-        sheet_fp = dir_ / meta["image"]
-        sheet = cv2.imread(str(sheet_fp), cv2.IMREAD_UNCHANGED)
+        sheet = sheets[meta_fp]
         layer_names = [layer["name"] for layer in meta["layers"]]
         if _SPRITE_LAYER not in layer_names:
             raise ValueError(f"{meta_fp} is missing the `sprite` layer")
 
+        records = []
         for frame in frames:
             name = frame["filename"]
             sprite_name, layer_name, tag, frame_idx = name.split(".")
@@ -126,7 +201,7 @@ if __name__ == "__main__":
 
             is_mask = False
             if layer_name.startswith(_MASK_LAYER_PREFIX):
-                layer_name = re.sub(r"^mask_", "", layer_name)
+                layer_name = layer_name.removeprefix(_MASK_LAYER_PREFIX)
                 is_mask = True
             elif layer_name != _SPRITE_LAYER:
                 raise ValueError(
@@ -145,7 +220,34 @@ if __name__ == "__main__":
                 w += 2
                 h += 2
 
-                image = sheet[y : y + h, x : x + w, :]
+            records.append(
+                (sprite_name, layer_name, is_mask, frame_idx, x, y, w, h)
+            )
+
+        # NOTE:
+        # Frames of the same size are cropped from the sheet by a single
+        # gather instead of slicing the sheet frame by frame. Sprite and
+        # mask frames are grouped separately, so only mask batches are
+        # reduced to 2d
+        groups = defaultdict(list)
+        for i, (_, layer_name, *_, w, h) in enumerate(records):
+            groups[(layer_name == _SPRITE_LAYER, w, h)].append(i)
+
+        images = [None] * len(records)
+        for (is_sprite, w, h), inds in groups.items():
+            xs = np.array([records[i][4] for i in inds])
+            ys = np.array([records[i][5] for i in inds])
+            frames_batch = _crop_frames(sheet, xs, ys, w, h)
+            if not is_sprite:
+                frames_batch = frames_batch.max(-1)
+
+            for i, image in zip(inds, frames_batch):
+                images[i] = image
+
+        for record, image in zip(records, images):
+            sprite_name, layer_name, is_mask, frame_idx, *_ = record
+
+            if layer_name == _SPRITE_LAYER:
                 sprite = Sprite(
                     name=sprite_name,
                     frame_idx=frame_idx,
@@ -154,15 +256,11 @@ if __name__ == "__main__":
                 )
                 sprites[sprite_name].append(sprite)
             elif is_mask:
-                image = sheet[y : y + h, x : x + w, :].max(-1)
                 mask = None
                 if image.max() > 0:
-                    row = image.max(0)
-                    col = image.max(1)
-                    left_x = row.argmax()
-                    top_y = col.argmax()
-                    right_x = len(row) - row[::-1].argmax()
-                    bot_y = len(col) - col[::-1].argmax()
+                    ys, xs = np.nonzero(image)
+                    top_y, bot_y = int(ys.min()), int(ys.max()) + 1
+                    left_x, right_x = int(xs.min()), int(xs.max()) + 1
 
                     w = right_x - left_x
                     h = bot_y - top_y
@@ -177,59 +275,48 @@ if __name__ == "__main__":
                         h=h,
                     )
 
-                    masks[sprite_name][layer_name][frame_idx] = mask
+                    masks[(sprite_name, layer_name, frame_idx)] = mask
             else:
                 assert False, f"Unhandled layer: {layer_name}"
 
     # --------------------------------------------------------------------
     # Pack sprites on the sheet
+    # NOTE:
+    # Sprites are packed from the largest to the smallest one, which gives
+    # the tighter packing
     flat_sprites = list(chain(*sprites.values()))
     inds = sorted(
         range(len(flat_sprites)), key=lambda i: -flat_sprites[i].image.size
     )
+    flat_sprites = [flat_sprites[i] for i in inds]
+
+    # NOTE:
+    # Each sprite occupies 1 extra pixel on the right and bottom sides,
+    # so the sprites on the sheet are separated by the 1 pixel gap
+    sizes = [(sprite.w + 1, sprite.h + 1) for sprite in flat_sprites]
+    total_area = sum(w * h for w, h in sizes)
+    sheet_w = max(max(w for w, _ in sizes), math.ceil(math.sqrt(total_area)))
+    tls = _pack_skyline(sizes, sheet_w)
+
+    sheet_h = max(tl[1] + h for tl, (_, h) in zip(tls, sizes))
+    sheet_w = max(tl[0] + w for tl, (w, _) in zip(tls, sizes))
+    sheet = np.zeros((sheet_h, sheet_w, 4), dtype=np.uint8)
+    for sprite, tl in zip(flat_sprites, tls):
+        sprite.tl = tl
 
-    sheet = np.zeros((0, 0, 5), dtype=np.uint8)
-
-    tls_to_try = [(0, 0)]
-
+    # NOTE:
+    # Sprites of the same size are stacked into a single batch and
+    # blitted on the sheet by one fancy-index assignment
+    batches = defaultdict(list)
     for sprite in flat_sprites:
-        best_tl_idx = None
-        while best_tl_idx is None:
-            for i, tl in enumerate(tls_to_try):
-                min_x, min_y = tl
-                max_x = min_x + sprite.w
-                max_y = min_y + sprite.h
-                if (
-                    sheet.shape[1] > max_x
-                    and sheet.shape[0] > max_y
-                    and sheet[min_y:max_y, min_x:max_x, -1].max() == 0
-                ):
-                    best_tl_idx = i
-                    break
+        batches[sprite.image.shape].append(sprite)
 
-            if best_tl_idx is None:
-                new_sheet = np.zeros(
-                    (
-                        sheet.shape[0] + sprite.h,
-                        sheet.shape[1] + sprite.w,
-                        5,
-                    ),
-                    dtype=np.uint8,
-                )
-                new_sheet[: sheet.shape[0], : sheet.shape[1]] = sheet
-                sheet = new_sheet
+    for batch in batches.values():
+        xs = np.array([sprite.tl[0] for sprite in batch])
+        ys = np.array([sprite.tl[1] for sprite in batch])
+        images = np.stack([sprite.image for sprite in batch])
+        _blit_frames(sheet, xs, ys, images)
 
-        tl = tls_to_try.pop(best_tl_idx)
-        sprite.tl = tl
-
-        min_x, min_y = tl
-        max_x = min_x + sprite.w
-        max_y = min_y + sprite.h
-        sheet[min_y:max_y, min_x:max_x, :-1] = sprite.image
-        sheet[min_y:max_y, min_x:max_x, -1] = 1
-        tls_to_try.extend(sprite.get_neighbor_tls())
-
-    sheet = sheet[..., :-1]
     # --------------------------------------------------------------------
     # Prepare sheet meta file (sprites and colliders coordinates)
     sheet_h, sheet_w = sheet.shape[:2]
@@ -237,6 +324,10 @@ if __name__ == "__main__":
         "size": [sheet_w, sheet_h],
         "frames": defaultdict(list),
     }
+    frame_masks = defaultdict(dict)
+    for (sprite_name, layer_name, frame_idx), mask in masks.items():
+        frame_masks[(sprite_name, frame_idx)][layer_name] = mask
+
     for sprite_name in sprites:
         sprites_ = sprites[sprite_name]
 
@@ -245,10 +336,9 @@ if __name__ == "__main__":
             sprite_meta = sprite.to_meta()
 
             masks_meta = {}
-            for mask_name in masks[sprite_name]:
-                m = masks[sprite_name][mask_name].get(sprite.frame_idx)
-                if m:
-                    masks_meta[mask_name] = m.to_meta()
+            sprite_masks = frame_masks.get((sprite_name, sprite.frame_idx), {})
+            for mask_name, m in sprite_masks.items():
+                masks_meta[mask_name] = m.to_meta()
 
             frame_meta = {
                 _SPRITE_LAYER: sprite_meta,